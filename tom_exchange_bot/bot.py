@@ -17,25 +17,42 @@ TOM EXCHANGE — простой Telegram-бот обменника (один ф
 - Бан/разбан из заявки (и "Доступ запрещён" для забаненных)
 - Админка: курсы/мин сумма/крипты/кошельки/юзер поддержки
 - Рассылка оператором
+- Приём апдейтов: webhook (WEBHOOK_URL) или long polling
+- Незавершённые заявки (FSM) переживают перезапуск, если задан STATE_PATH
 """
 
+import atexit
+import heapq
+import hmac
+import json
 import os
+import queue
+import random
+import re
+import secrets
+import signal
 import threading
 import time
 import sqlite3
 import logging
-from decimal import Decimal, InvalidOperation, ROUND_CEILING, ROUND_FLOOR
-from datetime import datetime
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 
 import telebot
 from telebot import custom_filters
 from telebot.apihelper import ApiTelegramException
 from telebot.handler_backends import State, StatesGroup
-from telebot.storage import StateMemoryStorage
+from telebot.storage import StateStorageBase
 from telebot.types import (
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    CallbackQuery, Message
+    CallbackQuery, Message, Update
 )
 
 # ---------------- Конфигурация (ТОЛЬКО из окружения) ----------------
@@ -49,6 +66,27 @@ except ValueError:
     raise RuntimeError("OPERATOR_ID должен быть целым числом в окружении")
 
 DB_PATH = os.environ.get("DB_PATH", "orders.db")
+# Файл для FSM-состояний между перезапусками (пусто — только в памяти)
+STATE_PATH = os.environ.get("STATE_PATH", "")
+
+# Webhook: если WEBHOOK_URL задан — Telegram сам присылает апдейты (https терминирует прокси),
+# иначе работаем через long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+try:
+    WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+except ValueError:
+    raise RuntimeError("WEBHOOK_PORT должен быть целым числом в окружении")
+# Без секрета любой, кто знает URL, прислал бы апдейт "от оператора": если не задан — генерируем
+# на запуск (set_webhook вызывается при каждом старте, Telegram получает новый)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_BODY = 1 << 20  # байт; апдейты Telegram на порядки меньше
+
+# Потоков-обработчиков апдейтов (апдейты одного чата всегда идут в один поток)
+try:
+    BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "4"))
+except ValueError:
+    raise RuntimeError("BOT_WORKERS должен быть целым числом в окружении")
 
 # Дефолтные кошельки (можно менять из админки)
 LTC_WALLET_DEFAULT = os.environ.get("LTC_WALLET", "LWzfxJHnRswAhu5uYP1trdzVh68HrxYrDT")
@@ -61,23 +99,210 @@ DEFAULT_MIN_USD = "10.00"          # минималка в $
 DEFAULT_CRYPTOS = "USDT_TRON,LTC"  # доступные крипты
 DEFAULT_SUPPORT_USERNAME = "@TOM_EXCH_PMR"
 
+# что проставляется в settings при старте, если ключа ещё нет
+DEFAULT_SETTINGS = (
+    ("buy_rate", DEFAULT_BUY_RATE),
+    ("sell_rate", DEFAULT_SELL_RATE),
+    ("min_usd", DEFAULT_MIN_USD),
+    ("cryptos", DEFAULT_CRYPTOS),
+    ("support_username", DEFAULT_SUPPORT_USERNAME),
+    ("wallet_USDT_TRON", USDT_WALLET_DEFAULT),
+    ("wallet_LTC", LTC_WALLET_DEFAULT),
+)
+
+# потолок суммы заявки в $: опечатки вроде 1e20 не доходят до БД (amount_cents — INTEGER, 64 бита)
+MAX_USD = 1_000_000
+
 BONUS_BUY_AFTER = 5
 BONUS_DISCOUNT_RUB = 5
 
 ALLOWED_CRYPTOS = {"USDT_TRON", "LTC"}
 
+_CRYPTO_HUMAN = {"USDT_TRON": "USDT (TRC20)", "LTC": "LTC"}
+_DEFAULT_WALLETS = {"USDT_TRON": USDT_WALLET_DEFAULT, "LTC": LTC_WALLET_DEFAULT}
+
+IO_WORKERS = 16         # потоков в IO_EXECUTOR (уведомления, досохранение заявок, рассылка)
+BROADCAST_WORKERS = 6   # copy_message рассылки одновременно; заметно меньше IO_WORKERS, остальное — не ей
+BROADCAST_RATE = 25     # сообщений/сек — с запасом до общего лимита Telegram (~30/сек)
+BROADCAST_RETRIES = 3   # повторов одной копии после 429
+
 # ---------------- Логирование ----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+# ---------------- Хранилище состояний ----------------
+class _StateEntry:
+    __slots__ = ("state", "data")
+
+    def __init__(self, state):
+        self.state = state
+        self.data = {}
+
+class _LiveData:
+    """Контекст retrieve_data: отдаёт сам dict заявки, без deepcopy и сохранения на выходе."""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+class CompactStateStorage(StateStorageBase):
+    """
+    Замена StateMemoryStorage: один dict (chat_id, user_id) -> _StateEntry под локом.
+    Без строковых ключей и копирования данных на каждый retrieve_data; запись удаляется
+    вместе с delete_state.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def set_state(self, chat_id, user_id, state, business_connection_id=None,
+                  message_thread_id=None, bot_id=None):
+        if hasattr(state, "name"):
+            state = state.name
+        with self._lock:
+            entry = self._entries.get((chat_id, user_id))
+            if entry is None:
+                self._entries[(chat_id, user_id)] = _StateEntry(state)
+            else:
+                entry.state = state
+        return True
+
+    def get_state(self, chat_id, user_id, business_connection_id=None,
+                  message_thread_id=None, bot_id=None):
+        entry = self._entries.get((chat_id, user_id))
+        return entry.state if entry is not None else None
+
+    def delete_state(self, chat_id, user_id, business_connection_id=None,
+                     message_thread_id=None, bot_id=None):
+        with self._lock:
+            return self._entries.pop((chat_id, user_id), None) is not None
+
+    def set_data(self, chat_id, user_id, key, value, business_connection_id=None,
+                 message_thread_id=None, bot_id=None):
+        entry = self._entries.get((chat_id, user_id))
+        if entry is None:
+            raise RuntimeError(f"CompactStateStorage: нет состояния для {chat_id}:{user_id}")
+        entry.data[key] = value
+        return True
+
+    def get_data(self, chat_id, user_id, business_connection_id=None,
+                 message_thread_id=None, bot_id=None):
+        entry = self._entries.get((chat_id, user_id))
+        return entry.data if entry is not None else {}
+
+    def reset_data(self, chat_id, user_id, business_connection_id=None,
+                   message_thread_id=None, bot_id=None):
+        entry = self._entries.get((chat_id, user_id))
+        if entry is None:
+            return False
+        entry.data = {}
+        return True
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None,
+                             message_thread_id=None, bot_id=None):
+        return _LiveData(self.get_data(chat_id, user_id))
+
+    def save(self, chat_id, user_id, data, business_connection_id=None,
+             message_thread_id=None, bot_id=None):
+        entry = self._entries.get((chat_id, user_id))
+        if entry is None:
+            return False
+        entry.data = data
+        return True
+
+    def restore(self, chat_id, user_id, state, data: dict) -> bool:
+        """Вернуть состояние, только если у чата сейчас нет другого (атомарно)."""
+        if hasattr(state, "name"):
+            state = state.name
+        with self._lock:
+            if (chat_id, user_id) in self._entries:
+                return False
+            entry = self._entries[(chat_id, user_id)] = _StateEntry(state)
+            entry.data = data
+        return True
+
+    def dump(self, path: str):
+        """Снимок всех состояний в JSON (атомарно через временный файл)."""
+        # data копируем под локом: шарды могут менять живые словари, пока пишется файл
+        with self._lock:
+            items = [[chat_id, user_id, e.state, dict(e.data)] for (chat_id, user_id), e in self._entries.items()]
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            for chat_id, user_id, state, data in items:
+                entry = self._entries[(chat_id, user_id)] = _StateEntry(state)
+                entry.data = data
+
 # ---------------- Инициализация бота ----------------
-state_storage = StateMemoryStorage()
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", state_storage=state_storage)
+def _update_chat_id(update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+class ShardedTeleBot(telebot.TeleBot):
+    """
+    Апдейты раскладываются по очередям по chat_id, у каждой очереди свой поток:
+    порядок внутри чата сохраняется, а медленный хэндлер одного чата не держит остальные.
+    Хэндлеры выполняются прямо в потоке очереди (threaded=False).
+    """
+
+    def __init__(self, *args, shards: int = 4, **kwargs):
+        super().__init__(*args, threaded=False, **kwargs)
+        self._shards = [queue.Queue() for _ in range(max(1, shards))]
+        self._shards_started = False
+        self._shards_lock = threading.Lock()
+
+    def _start_shards(self):
+        with self._shards_lock:
+            if self._shards_started:
+                return
+            for i, q in enumerate(self._shards):
+                threading.Thread(target=self._shard_loop, args=(q,), name=f"updates-{i}", daemon=True).start()
+            self._shards_started = True
+
+    def _shard_loop(self, q):
+        while True:
+            update = q.get()
+            try:
+                super().process_new_updates([update])
+            except Exception:
+                logger.exception("Ошибка обработки апдейта")
+
+    def process_new_updates(self, updates):
+        if not self._shards_started:
+            self._start_shards()
+        for update in updates:
+            # polling берёт offset отсюда, поэтому двигаем его сразу, а не после обработки
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self._shards[_update_chat_id(update) % len(self._shards)].put(update)
+
+state_storage = CompactStateStorage()
+bot = ShardedTeleBot(BOT_TOKEN, parse_mode="HTML", state_storage=state_storage, shards=BOT_WORKERS)
 
 # ---------------- Состояния ----------------
 class OrderStates(StatesGroup):
     action = State()       # "buy" | "sell"
-    amount = State()       # Decimal (строкой)
+    amount = State()       # сумма в центах (int)
     crypto = State()       # "USDT_TRON" | "LTC"
     buy_method = State()   # "transfer" | "requisites" (для покупки)
     wait_tx = State()      # ожидание TX/скрина + реквизитов (для продажи)
@@ -92,19 +317,93 @@ class AdminStates(StatesGroup):
     wait_wallet_crypto = State()
 
 # ---------------- SQLite helper ----------------
-def get_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA synchronous=NORMAL;")
-    except Exception:
-        pass
+# Одно постоянное соединение на запись (под локом) + небольшой пул соединений только для чтения.
+READER_POOL_SIZE = 4
+
+SQLITE_BUSY_TIMEOUT_MS = 30000
+
+_SQLITE_PRAGMAS = (
+    "PRAGMA page_size=4096;",  # действует только для новой БД, поэтому до перехода в WAL
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-65536;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+def _tune_conn(conn):
+    for pragma in _SQLITE_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error:
+            logger.warning("Не удалось применить %s", pragma)
     return conn
 
+def _open_writer():
+    conn = sqlite3.connect(DB_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, isolation_level=None)
+    return _tune_conn(conn)
+
+def _open_reader():
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, isolation_level=None)
+    return _tune_conn(conn)
+
+_write_lock = threading.Lock()
+_writer_conn = _open_writer()  # создаёт файл БД, поэтому открываем раньше читателей
+
+_readers = queue.Queue()
+for _ in range(READER_POOL_SIZE):
+    _readers.put(_open_reader())
+
+def _close_connections():
+    with _write_lock:
+        _writer_conn.close()
+    while True:
+        try:
+            _readers.get_nowait().close()
+        except queue.Empty:
+            break
+
+atexit.register(_close_connections)
+
+@contextmanager
+def _write_tx():
+    """Транзакция на writer-соединении: блокировка записи берётся сразу (BEGIN IMMEDIATE)."""
+    with _write_lock:
+        _writer_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _writer_conn
+        except BaseException:
+            if _writer_conn.in_transaction:
+                _writer_conn.execute("ROLLBACK")
+            raise
+        _writer_conn.execute("COMMIT")
+
+@contextmanager
+def _reader():
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+_now_cache = (0, "")
+
+def _now_iso() -> str:
+    """UTC-время в ISO с точностью до секунды; строка переиспользуется в пределах одной секунды."""
+    global _now_cache
+    ts = int(time.time())
+    cached_ts, cached = _now_cache
+    if ts != cached_ts:
+        cached = datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+        _now_cache = (ts, cached)
+    return cached
+
 def db_init():
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
+    with _write_tx() as conn:
+        conn.execute("""
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -112,146 +411,300 @@ def db_init():
             full_name TEXT,
             action TEXT,
             amount TEXT,
+            amount_cents INTEGER,
             crypto TEXT,
             tx_info TEXT,
             status TEXT,
             created_at TEXT
         )
         """)
-        cur.execute("""
+        conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             full_name TEXT,
             first_seen TEXT,
             last_seen TEXT,
-            blocked INTEGER DEFAULT 0
+            blocked INTEGER DEFAULT 0,
+            approved_buys INTEGER NOT NULL DEFAULT 0
         )
         """)
-        cur.execute("""
+        conn.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT
         )
         """)
-        conn.commit()
+        # миграция: сумма в центах для старых БД (amount TEXT остаётся для совместимости)
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(orders)")}
+        if "amount_cents" not in cols:
+            conn.execute("ALTER TABLE orders ADD COLUMN amount_cents INTEGER")
+            conn.execute("""
+                UPDATE orders SET amount_cents = COALESCE(CAST(ROUND(CAST(amount AS REAL) * 100) AS INTEGER), 0)
+                WHERE amount_cents IS NULL
+            """)
+        # миграция: счётчик одобренных покупок хранится в users (ведёт db_update_status)
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+        if "approved_buys" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN approved_buys INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""
+                UPDATE users SET approved_buys = (
+                    SELECT COUNT(*) FROM orders o
+                    WHERE o.user_id = users.user_id AND o.action = 'buy' AND o.status = 'approved'
+                )
+            """)
+        # рассылка/подсчёт активных читают только этот частичный индекс, а не всю users
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(user_id) WHERE blocked = 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)")
+        # одобренные покупки считает users.approved_buys: составной индекс по orders больше
+        # никто не читает, а пишется он на каждой заявке и смене статуса
+        conn.execute("DROP INDEX IF EXISTS idx_orders_user_action_status")
+    db_load_settings()
+    _active_users.update(db_all_user_ids(only_active=True))
 
 # --- settings ---
+# Настройки меняет админка через db_set_setting, поэтому держим их в памяти процесса;
+# раз в SETTINGS_TTL перечитываем таблицу целиком — на случай правки БД мимо бота
+SETTINGS_TTL = 30  # сек
+_settings_cache = {}   # key -> value (None, если строки в БД нет)
+_settings_parsed = {}  # (key, parse) -> уже разобранное значение (Decimal и т.п.)
+_settings_lock = threading.RLock()
+_settings_loaded = 0.0
+_MISSING = object()
+
+def db_load_settings():
+    global _settings_loaded
+    with _settings_lock:
+        with _reader() as conn:
+            rows = dict(conn.execute("SELECT key, value FROM settings").fetchall())
+        # разобранные значения сбрасываем только у изменившихся ключей
+        changed = {k for k in _settings_cache.keys() | rows.keys() if _settings_cache.get(k) != rows.get(k)}
+        _settings_cache.clear()
+        _settings_cache.update(rows)
+        for k in [k for k in _settings_parsed if k[0] in changed]:
+            del _settings_parsed[k]
+        _settings_loaded = time.monotonic()
+
+def _settings_refresh():
+    if time.monotonic() - _settings_loaded > SETTINGS_TTL:
+        with _settings_lock:
+            if time.monotonic() - _settings_loaded > SETTINGS_TTL:
+                db_load_settings()
+
 def db_get_setting(key: str, default: str = None) -> str:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = cur.fetchone()
-        return row[0] if row and row[0] is not None else default
+    _settings_refresh()
+    value = _settings_cache.get(key, _MISSING)
+    if value is _MISSING:
+        with _reader() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        with _settings_lock:
+            # если db_set_setting успел записать новое значение — оставляем его
+            value = _settings_cache.setdefault(key, row[0] if row else None)
+    return value if value is not None else default
 
 def db_set_setting(key: str, value: str):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
+    with _write_tx() as conn:
+        conn.execute("""
             INSERT INTO settings(key, value) VALUES(?, ?)
             ON CONFLICT(key) DO UPDATE SET value = excluded.value
         """, (key, value))
-        conn.commit()
+    with _settings_lock:
+        _settings_cache[key] = value
+        for k in [k for k in _settings_parsed if k[0] == key]:
+            del _settings_parsed[k]
+
+def db_seed_settings(defaults):
+    """Проставляет отсутствующие ключи одной транзакцией; существующие не трогает."""
+    with _write_tx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO settings(key, value) VALUES(?, ?)", defaults)
+    db_load_settings()
+
+def _parsed_setting(key: str, default: str, parse):
+    _settings_refresh()
+    value = _settings_parsed.get((key, parse), _MISSING)
+    if value is _MISSING:
+        with _settings_lock:
+            value = _settings_parsed.get((key, parse), _MISSING)
+            if value is _MISSING:
+                value = _settings_parsed[(key, parse)] = parse(db_get_setting(key, default))
+    return value
 
 # --- users ---
-def db_upsert_user(user):
+def _user_row(user):
+    """Строка для UPSERT в users: (user_id, username, full_name, first_seen, last_seen)."""
     full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-    now = datetime.utcnow().isoformat()
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
+    now = _now_iso()
+    return (user.id, user.username, full_name, now, now)
+
+def db_upsert_users(rows):
+    with _write_tx() as conn:
+        conn.executemany("""
             INSERT INTO users (user_id, username, full_name, first_seen, last_seen, blocked)
             VALUES (?, ?, ?, ?, ?, 0)
             ON CONFLICT(user_id) DO UPDATE SET
                 username = excluded.username,
                 full_name = excluded.full_name,
                 last_seen = excluded.last_seen
-        """, (user.id, user.username, full_name, now, now))
-        conn.commit()
-
-def db_set_user_blocked(user_id: int, blocked: bool):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
+        """, rows)
+
+# Кэш флага blocked: deny_if_blocked зовётся в каждом хэндлере
+BLOCKED_CACHE_SIZE = 10000
+_blocked_cache = OrderedDict()  # user_id -> bool
+_blocked_lock = threading.Lock()
+_blocked_gen = 0  # растёт при каждом бане/разбане, чтобы не закэшировать устаревшее чтение
+# Незаблокированные пользователи: проверка в deny_if_blocked без БД и без LRU
+_active_users = set()
+
+def db_set_users_blocked(user_ids, blocked: bool = True):
+    global _blocked_gen
+    user_ids = list(user_ids)
+    flag, now = (1 if blocked else 0), _now_iso()
+    with _write_tx() as conn:
+        conn.executemany(
             "UPDATE users SET blocked = ?, last_seen = ? WHERE user_id = ?",
-            (1 if blocked else 0, datetime.utcnow().isoformat(), user_id)
+            [(flag, now, uid) for uid in user_ids]
         )
-        conn.commit()
+    with _blocked_lock:
+        _blocked_gen += 1
+        for uid in user_ids:
+            _blocked_cache.pop(uid, None)
+            if blocked:
+                _active_users.discard(uid)
+
+def db_set_user_blocked(user_id: int, blocked: bool):
+    db_set_users_blocked((user_id,), blocked)
 
 def db_is_user_blocked(user_id: int) -> bool:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT blocked FROM users WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        return bool(row and row[0] == 1)
+    if user_id in _active_users:
+        return False
+    with _blocked_lock:
+        cached = _blocked_cache.get(user_id)
+        if cached is not None:
+            _blocked_cache.move_to_end(user_id)
+            return cached
+        gen = _blocked_gen
+    with _reader() as conn:
+        row = conn.execute("SELECT blocked FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    blocked = bool(row and row[0] == 1)
+    with _blocked_lock:
+        if gen == _blocked_gen:
+            if row and not blocked:
+                _active_users.add(user_id)
+            else:
+                # заблокированные и ещё не записанные в users — в ограниченный LRU
+                _blocked_cache[user_id] = blocked
+                if len(_blocked_cache) > BLOCKED_CACHE_SIZE:
+                    _blocked_cache.popitem(last=False)
+    return blocked
+
+USER_IDS_PAGE = 1000
 
 def db_all_user_ids(only_active=True):
-    with get_conn() as conn:
-        cur = conn.cursor()
+    """Генератор user_id: читаем страницами по user_id, список целиком не собирается.
+
+    Соединение берётся на одну страницу, а не на всю рассылку: долгая read-транзакция
+    держала бы читателя из пула и не давала checkpoint'у укоротить WAL.
+    """
+    sql = (
+        "SELECT user_id FROM users WHERE blocked = 0 AND user_id > ? ORDER BY user_id LIMIT ?"
+        if only_active else
+        "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+    )
+    last = -1
+    while True:
+        with _reader() as conn:
+            rows = conn.execute(sql, (last, USER_IDS_PAGE)).fetchall()
+        if not rows:
+            return
+        yield from (r[0] for r in rows)
+        if len(rows) < USER_IDS_PAGE:
+            return
+        last = rows[-1][0]
+
+def db_count_users(only_active=True) -> int:
+    with _reader() as conn:
         if only_active:
-            cur.execute("SELECT user_id FROM users WHERE blocked = 0")
+            row = conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 0").fetchone()
         else:
-            cur.execute("SELECT user_id FROM users")
-        return [r[0] for r in cur.fetchall()]
+            row = conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        return int(row[0] or 0)
 
 # --- orders ---
-def db_create_order(user, action, amount, crypto, tx_info) -> int:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
-        now = datetime.utcnow().isoformat()
-        cur.execute("""
-            INSERT INTO orders (user_id, username, full_name, action, amount, crypto, tx_info, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user.id, user.username, full_name, action, str(amount), crypto, tx_info, "pending", now))
-        conn.commit()
-        return cur.lastrowid
-
-def db_update_status(order_id: int, status: str):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
-        conn.commit()
+def db_create_order(user, action, amount_cents: int, crypto, tx_info) -> int:
+    full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    now = _now_iso()
+    with _write_tx() as conn:
+        cur = conn.execute("""
+            INSERT INTO orders (user_id, username, full_name, action, amount, amount_cents,
+                                crypto, tx_info, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user.id, user.username, full_name, action, format_usd(amount_cents), amount_cents,
+              crypto, tx_info, "pending", now))
+    return cur.lastrowid
+
+def db_update_status(order_id: int, status: str, expected: str = None):
+    """
+    Меняет статус заявки и в той же транзакции правит users.approved_buys. Возвращает прежний статус.
+    Если задан expected и текущий статус другой — ничего не пишет.
+    """
+    with _write_tx() as conn:
+        row = conn.execute("SELECT user_id, action, status FROM orders WHERE id = ?", (order_id,)).fetchone()
+        if row is None:
+            return None
+        user_id, action, old = row
+        if expected is not None and old != expected:
+            return old
+        conn.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
+        if action == "buy" and (old == "approved") != (status == "approved"):
+            conn.execute(
+                "UPDATE users SET approved_buys = approved_buys + ? WHERE user_id = ?",
+                (1 if status == "approved" else -1, user_id)
+            )
+        return old
 
 def db_get_order(order_id: int):
-    with get_conn() as conn:
+    """sqlite3.Row: поля доступны по имени (row["status"])."""
+    with _reader() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT id, user_id, username, full_name, action, amount, crypto, tx_info, status, created_at
+        cur.row_factory = sqlite3.Row
+        return cur.execute("""
+            SELECT id, user_id, username, full_name, action, amount, crypto, tx_info, status, created_at,
+                   amount_cents
             FROM orders WHERE id = ?
-        """, (order_id,))
-        return cur.fetchone()
+        """, (order_id,)).fetchone()
 
 def db_count_approved_buys(user_id: int) -> int:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT COUNT(*) FROM orders
-            WHERE user_id = ? AND action = 'buy' AND status = 'approved'
-        """, (user_id,))
-        return int(cur.fetchone()[0] or 0)
-
-def db_count_orders(user_id: int) -> int:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
-        return int(cur.fetchone()[0] or 0)
+    with _reader() as conn:
+        row = conn.execute("SELECT approved_buys FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return int(row[0] or 0) if row else 0
+
+def db_order_stats(user_id: int):
+    """(всего заявок, выполненных покупок) одним запросом."""
+    with _reader() as conn:
+        row = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM orders WHERE user_id = ?),
+                   (SELECT approved_buys FROM users WHERE user_id = ?)
+        """, (user_id, user_id)).fetchone()
+        return int(row[0] or 0), int(row[1] or 0)
 
 def db_last_orders(user_id: int, limit: int = 5):
-    with get_conn() as conn:
+    with _reader() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT id, action, amount, crypto, status, created_at
+        cur.row_factory = sqlite3.Row
+        return cur.execute("""
+            SELECT id, action, amount_cents, crypto, status, created_at
             FROM orders
             WHERE user_id = ?
             ORDER BY id DESC
             LIMIT ?
-        """, (user_id, limit))
-        return cur.fetchall()
+        """, (user_id, limit)).fetchall()
 
 # ---------------- Утилиты ----------------
+# кавычку тоже экранируем: результат безопасен и внутри атрибута в двойных кавычках
+_HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
 def escape_html(s: str) -> str:
-    return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return (s or "").translate(_HTML_ESCAPE_TABLE)
 
 def user_link(u) -> str:
     name = (f"{u.first_name or ''} {u.last_name or ''}").strip() or f"id:{u.id}"
@@ -280,51 +733,86 @@ def get_user_status(buys: int) -> str:
     else:
         return "VIP-клиент"
 
+# Суммы в долларах храним целыми центами, курсы — точной дробью (num, den):
+# расчёт рублей идёт в int без Decimal.
+_CENT = Decimal("0.01")
+
 def parse_amount(text: str):
+    """Сумма в центах (int) или None."""
     try:
         t = text.replace(",", ".").strip()
+        # частый случай — целое число долларов: без разбора строки через Decimal
+        if t.isdecimal():
+            n = int(t)
+            return n * 100 if n > 0 else None
         amt = Decimal(t)
         if amt <= 0:
             return None
-        return amt.quantize(Decimal("0.01"))
-    except (InvalidOperation, AttributeError):
+        return int(amt.quantize(_CENT) * 100) or None
+    except (InvalidOperation, ValueError, AttributeError):
+        # ValueError — int() от строки длиннее лимита цифр интерпретатора
         return None
 
+def format_usd(cents: int) -> str:
+    return f"{cents // 100}.{cents % 100:02d}"
+
+def _ratio(value: str):
+    return Decimal(value).as_integer_ratio()
+
+def _to_cents_ceil(value: str) -> int:
+    num, den = _ratio(value)
+    return -(-num * 100 // den)
+
 def get_buy_rate() -> Decimal:
-    return Decimal(db_get_setting("buy_rate", DEFAULT_BUY_RATE))
+    return _parsed_setting("buy_rate", DEFAULT_BUY_RATE, Decimal)
 
 def get_sell_rate() -> Decimal:
-    return Decimal(db_get_setting("sell_rate", DEFAULT_SELL_RATE))
+    return _parsed_setting("sell_rate", DEFAULT_SELL_RATE, Decimal)
 
 def get_min_usd() -> Decimal:
-    return Decimal(db_get_setting("min_usd", DEFAULT_MIN_USD))
+    return _parsed_setting("min_usd", DEFAULT_MIN_USD, Decimal)
 
-def get_enabled_cryptos():
-    raw = db_get_setting("cryptos", DEFAULT_CRYPTOS) or DEFAULT_CRYPTOS
-    items = [x.strip() for x in raw.split(",") if x.strip()]
-    items = [x for x in items if x in ALLOWED_CRYPTOS]
-    return items or ["USDT_TRON", "LTC"]
+def get_min_cents() -> int:
+    return _parsed_setting("min_usd", DEFAULT_MIN_USD, _to_cents_ceil)
 
-def get_wallet(code: str) -> str:
-    default_wallet = USDT_WALLET_DEFAULT if code == "USDT_TRON" else LTC_WALLET_DEFAULT
-    return db_get_setting(f"wallet_{code}", default_wallet)
+def _parse_cryptos(raw: str) -> tuple:
+    items = [x.strip() for x in (raw or DEFAULT_CRYPTOS).split(",") if x.strip()]
+    items = [x for x in items if x in ALLOWED_CRYPTOS]
+    return tuple(items) or ("USDT_TRON", "LTC")
 
-def get_support_username() -> str:
-    v = (db_get_setting("support_username", DEFAULT_SUPPORT_USERNAME) or DEFAULT_SUPPORT_USERNAME).strip()
+def _parse_support_username(raw: str) -> str:
+    v = (raw or DEFAULT_SUPPORT_USERNAME).strip()
     if not v.startswith("@"):
         v = "@" + v
     return v
 
-def calc_rub(action: str, usd_amount: Decimal) -> int:
+def get_enabled_cryptos() -> tuple:
+    return _parsed_setting("cryptos", DEFAULT_CRYPTOS, _parse_cryptos)
+
+def get_wallet(code: str) -> str:
+    return db_get_setting(f"wallet_{code}", _DEFAULT_WALLETS[code])
+
+def get_support_username() -> str:
+    return _parsed_setting("support_username", DEFAULT_SUPPORT_USERNAME, _parse_support_username)
+
+def calc_rub(action: str, usd_cents: int) -> int:
     """Покупка: округление вверх, Продажа: округление вниз (пользователю про округление не пишем)."""
     if action == "buy":
-        rub = (usd_amount * get_buy_rate()).quantize(Decimal("1"), rounding=ROUND_CEILING)
-    else:
-        rub = (usd_amount * get_sell_rate()).quantize(Decimal("1"), rounding=ROUND_FLOOR)
-    return int(rub)
+        num, den = _parsed_setting("buy_rate", DEFAULT_BUY_RATE, _ratio)
+        return -(-usd_cents * num // (den * 100))
+    num, den = _parsed_setting("sell_rate", DEFAULT_SELL_RATE, _ratio)
+    return usd_cents * num // (den * 100)
+
+def buy_discount(user_id: int) -> int:
+    """Скидка в ₽ на покупку (по users.approved_buys)."""
+    return BONUS_DISCOUNT_RUB if db_count_approved_buys(user_id) >= BONUS_BUY_AFTER else 0
 
 def crypto_human(code: str) -> str:
-    return "USDT (TRC20)" if code == "USDT_TRON" else "LTC"
+    """Для заявок из БД: неизвестный код показываем как есть."""
+    return _CRYPTO_HUMAN.get(code, code or "—")
+
+_TX_RE = re.compile(r"^\s*(?:tx|hash|хеш|хэш):[ \t]*(.*?)\s*$", re.I | re.M)
+_PAYOUT_RE = re.compile(r"^\s*(?:выплата|карта|переводилка|payout):[ \t]*(.*?)\s*$", re.I | re.M)
 
 def split_tx_and_payout(text: str):
     """Достаём TX и реквизиты 'Выплата:' из текста (если есть)."""
@@ -332,24 +820,19 @@ def split_tx_and_payout(text: str):
     if not t:
         return "", ""
 
-    lines = [x.strip() for x in t.splitlines() if x.strip()]
-    payout = ""
-    tx = ""
+    # если поле указано несколько раз — берём последнее
+    payouts = _PAYOUT_RE.findall(t)
+    txs = _TX_RE.findall(t)
+    payout = payouts[-1] if payouts else ""
+    tx = txs[-1] if txs else ""
 
-    for line in lines:
-        low = line.lower()
-        if low.startswith(("выплата:", "карта:", "переводилка:", "payout:")):
-            payout = line.split(":", 1)[1].strip() if ":" in line else line
-        elif low.startswith(("tx:", "hash:", "хеш:", "хэш:")):
-            tx = line.split(":", 1)[1].strip() if ":" in line else line
-
-    if not tx and len(lines) == 1:
-        tx = lines[0]
+    if not tx and len(t.splitlines()) == 1:
+        tx = t
 
     return tx, payout
 
 # ---------------- Клавиатуры ----------------
-def main_menu(is_operator: bool = False) -> ReplyKeyboardMarkup:
+def _build_main_menu(is_operator: bool) -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("💰 Купить крипту"), KeyboardButton("💸 Продать крипту"))
     kb.add(KeyboardButton("👤 Личный кабинет"), KeyboardButton("📄 Мои заявки"))
@@ -359,19 +842,25 @@ def main_menu(is_operator: bool = False) -> ReplyKeyboardMarkup:
     return kb
 
 def crypto_kb() -> InlineKeyboardMarkup:
+    return _crypto_kb(get_enabled_cryptos())
+
+@lru_cache(maxsize=8)
+def _crypto_kb(enabled: tuple) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
-    enabled = get_enabled_cryptos()
     buttons = []
     for code in enabled:
-        if code == "USDT_TRON":
-            buttons.append(InlineKeyboardButton("USDT (TRC20)", callback_data="crypto:USDT_TRON"))
-        elif code == "LTC":
-            buttons.append(InlineKeyboardButton("LTC", callback_data="crypto:LTC"))
+        buttons.append(InlineKeyboardButton(_CRYPTO_HUMAN[code], callback_data=f"crypto:{code}"))
     if buttons:
         kb.add(*buttons)
     return kb
 
-def buymethod_kb() -> InlineKeyboardMarkup:
+@lru_cache(maxsize=8)
+def _support_kb(op: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("💬 Написать оператору", url=f"https://t.me/{op.lstrip('@')}"))
+    return kb
+
+def _build_buymethod_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.add(
         InlineKeyboardButton("Переводилка", callback_data="buymethod:transfer"),
@@ -379,12 +868,22 @@ def buymethod_kb() -> InlineKeyboardMarkup:
     )
     return kb
 
-def confirm_kb_for_sell() -> ReplyKeyboardMarkup:
+def _build_confirm_kb_for_sell() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("📤 Я отправил"))
     kb.add(KeyboardButton("Отмена"))
     return kb
 
+# Неизменяемые клавиатуры собираем один раз и переиспользуем во всех хэндлерах
+_MAIN_MENU_USER = _build_main_menu(False)
+_MAIN_MENU_OP = _build_main_menu(True)
+_BUYMETHOD_KB = _build_buymethod_kb()
+_CONFIRM_SELL_KB = _build_confirm_kb_for_sell()
+_CANCEL_KB = ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Отмена"))
+
+def _menu_for(user_id: int) -> ReplyKeyboardMarkup:
+    return _MAIN_MENU_OP if user_id == OPERATOR_ID else _MAIN_MENU_USER
+
 def operator_kb(order_id: int, user_id: int) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.add(
@@ -397,12 +896,12 @@ def operator_kb(order_id: int, user_id: int) -> InlineKeyboardMarkup:
     )
     return kb
 
-def myorders_kb():
+def _build_myorders_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("🔄 Обновить", callback_data="myorders:refresh"))
     return kb
 
-def admin_menu_kb():
+def _build_admin_menu_kb() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("Курс покупки"))
     kb.add(KeyboardButton("Курс продажи"))
@@ -413,10 +912,33 @@ def admin_menu_kb():
     kb.add(KeyboardButton("⬅ Назад"))
     return kb
 
+def _build_wallet_pick_kb() -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
+    kb.add(
+        InlineKeyboardButton("USDT_TRON", callback_data="admin_wallet:USDT_TRON"),
+        InlineKeyboardButton("LTC", callback_data="admin_wallet:LTC"),
+    )
+    return kb
+
+@lru_cache(maxsize=8)
+def _broadcast_confirm_kb(total: int) -> InlineKeyboardMarkup:
+    # в кнопке число получателей, поэтому кэш по total, а не один экземпляр
+    kb = InlineKeyboardMarkup()
+    kb.add(
+        InlineKeyboardButton(f"▶ Отправить ({total})", callback_data="broadcast:send"),
+        InlineKeyboardButton("Отмена", callback_data="broadcast:cancel")
+    )
+    return kb
+
+_MYORDERS_KB = _build_myorders_kb()
+_ADMIN_MENU_KB = _build_admin_menu_kb()
+_WALLET_PICK_KB = _build_wallet_pick_kb()
+
 # ---------------- Safe send helpers ----------------
 def _extract_retry_after(exc):
     try:
-        res = getattr(exc, "result", None)
+        # ответ API лежит в result_json; result — это объект HTTP-ответа
+        res = getattr(exc, "result_json", None)
         if isinstance(res, dict):
             params = res.get("parameters", {})
             ra = params.get("retry_after")
@@ -426,103 +948,189 @@ def _extract_retry_after(exc):
         pass
     return None
 
-def safe_send_message(chat_id, text, **kwargs):
+# Кто ответил 403 в этом процессе: рассылка их пропускает, не дожидаясь перечитывания users
+_recently_blocked = set()
+
+# После 429 отправки "размыкаются" до _send_paused_until: вызовы safe_* в это окно не идут в API,
+# а встают в очередь отложенных. Её разбирает один поток (экспоненциальная пауза с джиттером),
+# так что хэндлер на 429 не спит, а сразу получает None.
+# Очередь — куча по (due, seq): ранний повтор не ждёт за поздним.
+SEND_RETRIES = 3
+_send_paused_until = 0.0
+_retry_heap = []
+_retry_seq = 0
+_retry_started = False
+_retry_cond = threading.Condition()
+
+def _defer_send(fn, chat_id, args, kwargs, attempt: int, delay: float):
+    global _retry_seq, _retry_started
+    with _retry_cond:
+        _retry_seq += 1
+        heapq.heappush(_retry_heap, (time.monotonic() + delay, _retry_seq, attempt, fn, chat_id, args, kwargs))
+        _retry_cond.notify()
+        if not _retry_started:
+            threading.Thread(target=_retry_loop, name="tg-retry", daemon=True).start()
+            _retry_started = True
+
+def _retry_loop():
+    while True:
+        with _retry_cond:
+            while True:
+                wait = None
+                if _retry_heap:
+                    wait = max(_retry_heap[0][0], _send_paused_until) - time.monotonic()
+                    if wait <= 0:
+                        break
+                _retry_cond.wait(wait)
+            _, _, attempt, fn, chat_id, args, kwargs = heapq.heappop(_retry_heap)
+        _send_safe(fn, chat_id, args, kwargs, attempt)
+
+def _send_safe(fn, chat_id, args, kwargs, attempt: int = 0):
+    global _send_paused_until
+    name = fn.__name__.removeprefix("safe_")
     try:
-        return bot.send_message(chat_id, text, **kwargs)
+        return fn(chat_id, *args, **kwargs)
     except ApiTelegramException as e:
-        logger.warning("ApiTelegramException send_message to %s: %s", chat_id, e)
+        # 403 и 429 — штатные ответы API: пишем одну строку без traceback
         if e.error_code == 403:
+            logger.info("%s to %s: 403, бот заблокирован пользователем", name, chat_id)
+            _recently_blocked.add(chat_id)
             try:
                 db_set_user_blocked(chat_id, True)
             except Exception:
                 logger.exception("Не удалось пометить пользователя как заблокированного")
             return None
         if e.error_code == 429:
-            retry = _extract_retry_after(e) or 5
-            time.sleep(retry + 1)
-            try:
-                return bot.send_message(chat_id, text, **kwargs)
-            except Exception:
-                logger.exception("Ошибка после retry send_message")
+            if attempt >= SEND_RETRIES:
+                logger.warning("%s to %s: 429 после %s повторов, сообщение потеряно", name, chat_id, attempt)
                 return None
-        logger.exception("Необработанная ошибка send_message")
+            retry = _extract_retry_after(e) or 5
+            delay = retry * 2 ** attempt + random.uniform(0, 1)
+            _send_paused_until = max(_send_paused_until, time.monotonic() + retry)
+            logger.warning("%s to %s: 429, повтор через %.1f с", name, chat_id, delay)
+            _defer_send(fn, chat_id, args, kwargs, attempt + 1, delay)
+            return None
+        logger.exception("Необработанная ошибка %s to %s", name, chat_id)
         return None
     except Exception:
-        logger.exception("Ошибка send_message")
+        logger.exception("Ошибка %s", name)
         return None
 
-def safe_copy_message(chat_id, from_chat_id, message_id):
-    try:
-        return bot.copy_message(chat_id, from_chat_id, message_id)
-    except ApiTelegramException as e:
-        logger.warning("ApiTelegramException copy_message to %s: %s", chat_id, e)
-        if e.error_code == 403:
-            try:
-                db_set_user_blocked(chat_id, True)
-            except Exception:
-                logger.exception("Не удалось пометить пользователя как заблокированного")
+def telegram_safe(fn):
+    """Отправка без исключений: 403 — помечаем юзера заблокированным, 429 — откладываем в tg-retry (см. выше)."""
+    @wraps(fn)
+    def wrapper(chat_id, *args, **kwargs):
+        paused = _send_paused_until - time.monotonic()
+        if paused > 0:
+            _defer_send(fn, chat_id, args, kwargs, 0, paused)
             return None
-        if e.error_code == 429:
-            retry = _extract_retry_after(e) or 5
-            time.sleep(retry + 1)
-            try:
-                return bot.copy_message(chat_id, from_chat_id, message_id)
-            except Exception:
-                logger.exception("Ошибка после retry copy_message")
-                return None
-        return None
-    except Exception:
-        logger.exception("Ошибка copy_message")
-        return None
+        return _send_safe(fn, chat_id, args, kwargs)
+
+    return wrapper
 
+@telegram_safe
+def safe_send_message(chat_id, text, **kwargs):
+    return bot.send_message(chat_id, text, **kwargs)
+
+@telegram_safe
 def safe_send_photo(chat_id, photo, caption=None, **kwargs):
-    try:
-        return bot.send_photo(chat_id, photo, caption=caption, **kwargs)
-    except ApiTelegramException as e:
-        logger.warning("ApiTelegramException send_photo to %s: %s", chat_id, e)
-        if e.error_code == 403:
-            try:
-                db_set_user_blocked(chat_id, True)
-            except Exception:
-                logger.exception("Не удалось пометить пользователя как заблокированного")
-            return None
-        if e.error_code == 429:
-            retry = _extract_retry_after(e) or 5
-            time.sleep(retry + 1)
-            try:
-                return bot.send_photo(chat_id, photo, caption=caption, **kwargs)
-            except Exception:
-                logger.exception("Ошибка после retry send_photo")
-                return None
-        return None
-    except Exception:
-        logger.exception("Ошибка send_photo")
-        return None
+    return bot.send_photo(chat_id, photo, caption=caption, **kwargs)
+
+@telegram_safe
+def safe_send_chat_action(chat_id, action):
+    return bot.send_chat_action(chat_id, action)
+
+# Общий пул для I/O вне хэндлеров: уведомления "другой стороне", досохранение заявок, рассылка.
+# Round-trip'ы к Bot API идут параллельно, у каждого потока свой keep-alive session
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="tg-io")
+atexit.register(IO_EXECUTOR.shutdown, wait=False)
+
+def send_in_background(fn, *args, **kwargs):
+    """fn — один из safe_*: исключений не бросает, результат не нужен."""
+    IO_EXECUTOR.submit(fn, *args, **kwargs)
 
 # ---------------- Трекинг пользователей ----------------
+# Новых пользователей listener пишет сразу (строка users нужна бану/рассылке),
+# остальных кладёт в очередь; фоновый поток раз в UPSERT_BATCH_WINDOW пишет накопленное
+# одной транзакцией, схлопывая повторы одного user_id (остаётся последняя запись).
+# Строки не задерживаются в потоке между get и записью, поэтому при выходе их дописывает flush_upserts.
+UPSERT_BATCH_WINDOW = 2.0  # сек
+
+_upsert_q = queue.Queue()
+_known_users = set()  # user_id, уже записанные в этом процессе
+
 def listener(messages):
     for msg in messages:
         try:
             if getattr(msg, "from_user", None):
-                db_upsert_user(msg.from_user)
+                row = _user_row(msg.from_user)
+                if row[0] in _known_users:
+                    _upsert_q.put(row)
+                else:
+                    db_upsert_users([row])
+                    _known_users.add(row[0])
         except Exception:
             logger.exception("Ошибка при апдейте пользователя из listener")
 
+def flush_upserts():
+    """Забирает из очереди всё накопленное и пишет одной транзакцией."""
+    batch = {}
+    while True:
+        try:
+            row = _upsert_q.get_nowait()
+        except queue.Empty:
+            break
+        batch[row[0]] = row
+    if not batch:
+        return
+    try:
+        db_upsert_users(list(batch.values()))
+    except Exception:
+        logger.exception("Ошибка пакетной записи пользователей")
+
+def _upsert_loop():
+    while True:
+        time.sleep(UPSERT_BATCH_WINDOW)
+        flush_upserts()
+
 bot.set_update_listener(listener)
 
 # ---------------- Проверка блокировки ----------------
 def deny_if_blocked(user_id: int, chat_id: int) -> bool:
-    if user_id == OPERATOR_ID:
+    if user_id == OPERATOR_ID or user_id in _active_users:
         return False
     if db_is_user_blocked(user_id):
         bot.send_message(chat_id, "🚫 Доступ запрещён.")
         return True
     return False
 
+# ---------------- Только для оператора ----------------
+_DENY_TEXT = "Недостаточно прав"
+
+def _deny_callback(c: CallbackQuery):
+    bot.answer_callback_query(c.id, _DENY_TEXT)
+
+def _deny_message(m: Message):
+    bot.send_message(m.chat.id, f"{_DENY_TEXT}.", reply_markup=_MAIN_MENU_USER)
+
+def _drop_state(m: Message):
+    bot.delete_state(m.from_user.id, m.chat.id)
+
+def operator_only(on_deny):
+    """Хэндлер только для оператора; остальным — on_deny(update)."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(update):
+            if update.from_user.id != OPERATOR_ID:
+                on_deny(update)
+                return None
+            return fn(update)
+        return wrapper
+    return deco
+
 # ---------------- Хэндлеры ----------------
 @bot.message_handler(commands=["start"])
 def cmd_start(m: Message):
-    is_op = (m.from_user.id == OPERATOR_ID)
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
     try:
@@ -533,72 +1141,76 @@ def cmd_start(m: Message):
         m.chat.id,
         "Вас приветствует <b>TOM EXCHANGE</b> 👋\n"
         "Выберите действие ниже.",
-        reply_markup=main_menu(is_op)
+        reply_markup=_menu_for(m.from_user.id)
     )
 
 @bot.message_handler(commands=["cancel"])
 def cmd_cancel(m: Message):
-    is_op = (m.from_user.id == OPERATOR_ID)
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
     try:
         bot.delete_state(m.from_user.id, m.chat.id)
     except Exception:
         pass
-    bot.send_message(m.chat.id, "Действие отменено.", reply_markup=main_menu(is_op))
+    bot.send_message(m.chat.id, "Действие отменено.", reply_markup=_menu_for(m.from_user.id))
+
+# --- Кнопки меню: один хэндлер со словарём маршрутов вместо func=lambda на каждую кнопку ---
+@bot.message_handler(func=lambda m: getattr(m, "text", None) in _TEXT_ROUTES)
+def route_text(m: Message):
+    _TEXT_ROUTES[m.text](m)
+
+# --- Inline-кнопки: маршрут по префиксу callback_data ("approve:12" -> "approve") ---
+@bot.callback_query_handler(func=lambda c: True)
+def route_callback(c: CallbackQuery):
+    route = _CALLBACK_ROUTES.get((c.data or "").split(":", 1)[0])
+    if route is None:
+        return
+    fn, state = route
+    if state is not None and bot.get_state(c.from_user.id, c.message.chat.id) != state.name:
+        return
+    fn(c)
 
-@bot.message_handler(func=lambda msg: getattr(msg, "text", "") == "Отмена")
 def cancel_btn(m: Message):
-    is_op = (m.from_user.id == OPERATOR_ID)
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
     try:
         bot.delete_state(m.from_user.id, m.chat.id)
     except Exception:
         pass
-    bot.send_message(m.chat.id, "Отменено.", reply_markup=main_menu(is_op))
+    bot.send_message(m.chat.id, "Отменено.", reply_markup=_menu_for(m.from_user.id))
 
 # --- Поддержка ---
-@bot.message_handler(func=lambda msg: getattr(msg, "text", "") == "👨‍💻 Поддержка")
 def support(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    is_op = (m.from_user.id == OPERATOR_ID)
     op = get_support_username()
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("💬 Написать оператору", url=f"https://t.me/{op.lstrip('@')}"))
-    bot.send_message(m.chat.id, f"Оператор: <b>{escape_html(op)}</b>", reply_markup=kb)
-    bot.send_message(m.chat.id, "Вернуться в меню: /start", reply_markup=main_menu(is_op))
+    bot.send_message(m.chat.id, f"Оператор: <b>{escape_html(op)}</b>", reply_markup=_support_kb(op))
+    bot.send_message(m.chat.id, "Вернуться в меню: /start", reply_markup=_menu_for(m.from_user.id))
 
 # --- Бонусы ---
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "🎁 Бонусы")
 def bonuses(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    is_op = (m.from_user.id == OPERATOR_ID)
     done = db_count_approved_buys(m.from_user.id)
     left = max(0, BONUS_BUY_AFTER - done)
     if done >= BONUS_BUY_AFTER:
         bot.send_message(
             m.chat.id,
             f"🎁 Скидка <b>{BONUS_DISCOUNT_RUB} ₽</b> активна и применяется при покупке.",
-            reply_markup=main_menu(is_op)
+            reply_markup=_menu_for(m.from_user.id)
         )
     else:
         bot.send_message(
             m.chat.id,
             f"🎁 До скидки осталось покупок: <b>{left}</b>\nВыполнено покупок: <b>{done}</b>",
-            reply_markup=main_menu(is_op)
+            reply_markup=_menu_for(m.from_user.id)
         )
 
 # --- Личный кабинет ---
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "👤 Личный кабинет")
 def profile(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    is_op = (m.from_user.id == OPERATOR_ID)
-    total_orders = db_count_orders(m.from_user.id)
-    approved_buys = db_count_approved_buys(m.from_user.id)
+    total_orders, approved_buys = db_order_stats(m.from_user.id)
     status = get_user_status(approved_buys)
 
     if approved_buys >= BONUS_BUY_AFTER:
@@ -615,27 +1227,29 @@ def profile(m: Message):
         f"Всего заявок: <b>{total_orders}</b>\n"
         f"Покупок выполнено: <b>{approved_buys}</b>\n"
         f"🎁 {escape_html(bonus_text)}",
-        reply_markup=main_menu(is_op)
+        reply_markup=_menu_for(m.from_user.id)
     )
 
 # --- Мои заявки ---
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "📄 Мои заявки")
+def _orders_text(rows) -> str:
+    lines = ["📄 <b>Ваши последние заявки</b>\n"]
+    for r in rows:
+        a = "Покупка" if r["action"] == "buy" else "Продажа"
+        lines.append(
+            f"#{r['id']} — {a} — {format_usd(r['amount_cents'])}$ — {crypto_human(r['crypto'])} — <b>{status_human(r['status'])}</b>"
+        )
+    return "\n".join(lines)
+
 def my_orders(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
     rows = db_last_orders(m.from_user.id, 5)
     if not rows:
-        bot.send_message(m.chat.id, "У вас пока нет заявок.", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
+        bot.send_message(m.chat.id, "У вас пока нет заявок.", reply_markup=_menu_for(m.from_user.id))
         return
 
-    lines = ["📄 <b>Ваши последние заявки</b>\n"]
-    for oid, action, amount, crypto, status, created_at in rows:
-        a = "Покупка" if action == "buy" else "Продажа"
-        lines.append(f"#{oid} — {a} — {amount}$ — {crypto_human(crypto)} — <b>{status_human(status)}</b>")
-
-    bot.send_message(m.chat.id, "\n".join(lines), reply_markup=myorders_kb())
+    bot.send_message(m.chat.id, _orders_text(rows), reply_markup=_MYORDERS_KB)
 
-@bot.callback_query_handler(func=lambda c: c.data == "myorders:refresh")
 def myorders_refresh(c: CallbackQuery):
     if deny_if_blocked(c.from_user.id, c.message.chat.id):
         bot.answer_callback_query(c.id)
@@ -645,11 +1259,7 @@ def myorders_refresh(c: CallbackQuery):
     if not rows:
         text = "У вас пока нет заявок."
     else:
-        lines = ["📄 <b>Ваши последние заявки</b>\n"]
-        for oid, action, amount, crypto, status, created_at in rows:
-            a = "Покупка" if action == "buy" else "Продажа"
-            lines.append(f"#{oid} — {a} — {amount}$ — {crypto_human(crypto)} — <b>{status_human(status)}</b>")
-        text = "\n".join(lines)
+        text = _orders_text(rows)
 
     bot.answer_callback_query(c.id, "Обновлено")
     try:
@@ -657,10 +1267,10 @@ def myorders_refresh(c: CallbackQuery):
             text,
             chat_id=c.message.chat.id,
             message_id=c.message.message_id,
-            reply_markup=myorders_kb()
+            reply_markup=_MYORDERS_KB
         )
     except Exception:
-        bot.send_message(c.message.chat.id, text, reply_markup=myorders_kb())
+        bot.send_message(c.message.chat.id, text, reply_markup=_MYORDERS_KB)
 
 # --- /status 123 ---
 @bot.message_handler(commands=["status"])
@@ -684,48 +1294,44 @@ def cmd_status(m: Message):
         bot.send_message(m.chat.id, "Заявка не найдена.")
         return
 
-    user_id = row[1]
-    if m.from_user.id != OPERATOR_ID and user_id != m.from_user.id:
+    if m.from_user.id != OPERATOR_ID and row["user_id"] != m.from_user.id:
         bot.send_message(m.chat.id, "Это не ваша заявка.")
         return
 
-    status = row[8]
-    action = row[4]
-    amount = row[5]
-    crypto = row[6]
-    a = "Покупка" if action == "buy" else "Продажа"
+    a = "Покупка" if row["action"] == "buy" else "Продажа"
 
     bot.send_message(
         m.chat.id,
         f"📌 Заявка <b>#{order_id}</b>\n"
-        f"{a} — {amount}$ — {crypto_human(crypto)}\n"
-        f"Статус: <b>{status_human(status)}</b>"
+        f"{a} — {format_usd(row['amount_cents'])}$ — {crypto_human(row['crypto'])}\n"
+        f"Статус: <b>{status_human(row['status'])}</b>"
     )
 
 # --- Старт покупки/продажи ---
-@bot.message_handler(func=lambda msg: getattr(msg, "text", "") == "💰 Купить крипту")
 def buy_crypto(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    bot.set_state(m.from_user.id, OrderStates.action, m.chat.id)
+    bot.set_state(m.from_user.id, OrderStates.amount, m.chat.id)
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
+        data.clear()  # новая заявка не должна видеть сумму/крипту от брошенной
         data["action"] = "buy"
-    bot.set_state(m.from_user.id, OrderStates.amount, m.chat.id)
-    kb = ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Отмена"))
-    bot.send_message(m.chat.id, "Введите сумму в $ (например, 150 или 150.50)", reply_markup=kb)
+    bot.send_message(m.chat.id, "Введите сумму в $ (например, 150 или 150.50)", reply_markup=_CANCEL_KB)
 
-@bot.message_handler(func=lambda msg: getattr(msg, "text", "") == "💸 Продать крипту")
 def sell_crypto(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    bot.set_state(m.from_user.id, OrderStates.action, m.chat.id)
+    bot.set_state(m.from_user.id, OrderStates.amount, m.chat.id)
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
+        data.clear()  # новая заявка не должна видеть сумму/крипту от брошенной
         data["action"] = "sell"
-    bot.set_state(m.from_user.id, OrderStates.amount, m.chat.id)
-    kb = ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Отмена"))
-    bot.send_message(m.chat.id, "Введите сумму в $ (например, 200 или 200.00)", reply_markup=kb)
+    bot.send_message(m.chat.id, "Введите сумму в $ (например, 200 или 200.00)", reply_markup=_CANCEL_KB)
 
 # --- Ввод суммы ---
+_CALC_HEAD = "💱 <b>Расчёт заявки</b>\n\nСумма: <b>%s$</b>\n"
+_CALC_BUY = _CALC_HEAD + "К оплате: <b>%d ₽</b>"
+_CALC_BUY_DISCOUNT = _CALC_BUY + "\nСкидка: <b>%d ₽</b>"
+_CALC_SELL = _CALC_HEAD + "Вы получите: <b>%d ₽</b>"
+
 @bot.message_handler(state=OrderStates.amount, content_types=["text"])
 def handle_amount(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
@@ -736,9 +1342,12 @@ def handle_amount(m: Message):
         bot.send_message(m.chat.id, "Введите корректную сумму > 0. Пример: 100 или 100.50")
         return
 
-    min_usd = get_min_usd()
-    if amt < min_usd:
-        bot.send_message(m.chat.id, f"Минимальная сумма: <b>{min_usd}$</b>. Введите сумму заново.")
+    if amt < get_min_cents():
+        bot.send_message(m.chat.id, f"Минимальная сумма: <b>{get_min_usd()}$</b>. Введите сумму заново.")
+        return
+
+    if amt > MAX_USD * 100:
+        bot.send_message(m.chat.id, f"Максимальная сумма: <b>{format_usd(MAX_USD * 100)}$</b>. Введите сумму заново.")
         return
 
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
@@ -750,43 +1359,28 @@ def handle_amount(m: Message):
             except Exception:
                 pass
             return
-        data["amount"] = str(amt)
+        data["amount"] = amt
+        # скидку считаем один раз на заявку: select_buy_method берёт её отсюда, без БД
+        discount = data["discount"] = buy_discount(m.from_user.id) if action == "buy" else 0
+    usd = format_usd(amt)
 
     rub = calc_rub(action, amt)
 
     # скидка только при покупке
     if action == "buy":
-        discount = BONUS_DISCOUNT_RUB if db_count_approved_buys(m.from_user.id) >= BONUS_BUY_AFTER else 0
-        pay_rub = max(0, rub - discount)
         if discount > 0:
-            bot.send_message(
-                m.chat.id,
-                f"💱 <b>Расчёт заявки</b>\n\n"
-                f"Сумма: <b>{amt}$</b>\n"
-                f"К оплате: <b>{pay_rub} ₽</b>\n"
-                f"Скидка: <b>{discount} ₽</b>"
-            )
+            text = _CALC_BUY_DISCOUNT % (usd, max(0, rub - discount), discount)
         else:
-            bot.send_message(
-                m.chat.id,
-                f"💱 <b>Расчёт заявки</b>\n\n"
-                f"Сумма: <b>{amt}$</b>\n"
-                f"К оплате: <b>{rub} ₽</b>"
-            )
+            text = _CALC_BUY % (usd, rub)
     else:
-        bot.send_message(
-            m.chat.id,
-            f"💱 <b>Расчёт заявки</b>\n\n"
-            f"Сумма: <b>{amt}$</b>\n"
-            f"Вы получите: <b>{rub} ₽</b>"
-        )
+        text = _CALC_SELL % (usd, rub)
+    bot.send_message(m.chat.id, text)
 
     bot.set_state(m.from_user.id, OrderStates.crypto, m.chat.id)
-    bot.send_message(m.chat.id, "Выберите криптовалюту:", reply_markup=ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Отмена")))
+    bot.send_message(m.chat.id, "Выберите криптовалюту:", reply_markup=_CANCEL_KB)
     bot.send_message(m.chat.id, "Доступные варианты:", reply_markup=crypto_kb())
 
 # --- Выбор криптовалюты (inline) ---
-@bot.callback_query_handler(func=lambda c: c.data.startswith("crypto:"), state=OrderStates.crypto)
 def select_crypto(c: CallbackQuery):
     if deny_if_blocked(c.from_user.id, c.message.chat.id):
         bot.answer_callback_query(c.id)
@@ -803,31 +1397,49 @@ def select_crypto(c: CallbackQuery):
         amt = data.get("amount")
 
     bot.answer_callback_query(c.id)
-    human = crypto_human(code)
+    human = _CRYPTO_HUMAN[code]
 
     if action == "buy":
         bot.set_state(c.from_user.id, OrderStates.buy_method, c.message.chat.id)
         bot.send_message(
             c.message.chat.id,
-            f"Заявка: Покупка\nСумма: <b>{escape_html(str(amt))}$</b>\nКриптовалюта: <b>{escape_html(human)}</b>\n\n"
+            f"Заявка: Покупка\nСумма: <b>{format_usd(amt)}$</b>\nКриптовалюта: <b>{escape_html(human)}</b>\n\n"
             "Выберите способ оплаты:",
-            reply_markup=buymethod_kb()
+            reply_markup=_BUYMETHOD_KB
         )
     else:
         wallet = get_wallet(code)
         bot.send_message(
             c.message.chat.id,
-            f"Заявка: Продажа\nСумма: <b>{escape_html(str(amt))}$</b>\nКриптовалюта: <b>{escape_html(human)}</b>"
+            f"Заявка: Продажа\nСумма: <b>{format_usd(amt)}$</b>\nКриптовалюта: <b>{escape_html(human)}</b>"
         )
         bot.send_message(
             c.message.chat.id,
             f"Отправьте <b>{escape_html(human)}</b> на адрес:\n<code>{escape_html(wallet)}</code>\n\n"
             "После отправки нажмите «Я отправил».",
-            reply_markup=confirm_kb_for_sell()
+            reply_markup=_CONFIRM_SELL_KB
         )
 
+# --- Уведомления оператору о новой заявке ---
+_OP_ORDER_HEAD = (
+    "📩 <b>Новая заявка — {kind}</b>\n\n"
+    "ID заявки: <b>#{{id}}</b>\n"
+    "Пользователь: {{user}} @{{username}}\n"
+    "Сумма: <b>{{amount}}$</b>\n"
+    "Криптовалюта: <b>{{crypto}}</b>\n"
+)
+_OP_BUY_TMPL = _OP_ORDER_HEAD.format(kind="ПОКУПКА") + (
+    "Способ оплаты: <b>{method}</b>\n"
+    "Статус: <b>pending</b>"
+)
+_OP_DISCOUNT_TMPL = "\n🎁 Скидка: <b>{discount} ₽</b>"
+_OP_SELL_TMPL = _OP_ORDER_HEAD.format(kind="ПРОДАЖА") + (
+    "Выплата: <b>{payout}</b>\n"
+    "TX: {tx}\n"
+    "Статус: <b>pending</b>"
+)
+
 # --- Покупка: выбор способа оплаты (inline) ---
-@bot.callback_query_handler(func=lambda c: c.data.startswith("buymethod:"), state=OrderStates.buy_method)
 def select_buy_method(c: CallbackQuery):
     if deny_if_blocked(c.from_user.id, c.message.chat.id):
         bot.answer_callback_query(c.id)
@@ -842,6 +1454,7 @@ def select_buy_method(c: CallbackQuery):
         action = data.get("action")
         amount = data.get("amount")
         crypto = data.get("crypto")
+        discount = data.get("discount", 0)
 
     if action != "buy" or not all([amount, crypto]):
         bot.answer_callback_query(c.id, "Заявка потеряна. Нажмите /start")
@@ -849,47 +1462,46 @@ def select_buy_method(c: CallbackQuery):
         return
 
     bot.answer_callback_query(c.id)
-    human = crypto_human(crypto)
+    human = _CRYPTO_HUMAN[crypto]
     method_human = "Переводилка" if method_code == "transfer" else "Реквизиты"
 
-    discount = BONUS_DISCOUNT_RUB if db_count_approved_buys(c.from_user.id) >= BONUS_BUY_AFTER else 0
-
     order_id = db_create_order(c.from_user, "buy", amount, crypto, f"buy_method:{method_code}")
 
-    extra = f"\n🎁 Скидка: <b>{discount} ₽</b>" if discount > 0 else ""
-    text = (
-        f"📩 <b>Новая заявка — ПОКУПКА</b>\n\n"
-        f"ID заявки: <b>#{order_id}</b>\n"
-        f"Пользователь: {user_link(c.from_user)} @{escape_html(c.from_user.username or '—')}\n"
-        f"Сумма: <b>{escape_html(str(amount))}$</b>\n"
-        f"Криптовалюта: <b>{escape_html(human)}</b>\n"
-        f"Способ оплаты: <b>{method_human}</b>\n"
-        f"Статус: <b>pending</b>{extra}"
-    )
-    safe_send_message(OPERATOR_ID, text, reply_markup=operator_kb(order_id, c.from_user.id))
+    # human/method_human — наши константы: экранируем только username
+    text = _OP_BUY_TMPL.format_map({
+        "id": order_id,
+        "user": user_link(c.from_user),
+        "username": escape_html(c.from_user.username or "—"),
+        "amount": format_usd(amount),
+        "crypto": human,
+        "method": method_human,
+    })
+    if discount > 0:
+        text += _OP_DISCOUNT_TMPL.format_map({"discount": discount})
+    send_in_background(safe_send_message, OPERATOR_ID, text, reply_markup=operator_kb(order_id, c.from_user.id))
 
     bot.send_message(
         c.message.chat.id,
         f"✅ Заявка отправлена! Номер: <b>#{order_id}</b>\nОжидайте ответа оператора.",
-        reply_markup=main_menu(False)
+        reply_markup=_MAIN_MENU_USER
     )
     bot.delete_state(c.from_user.id, c.message.chat.id)
 
 # --- Продажа: клиент нажал "Я отправил" ---
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "📤 Я отправил")
 def confirm_sent(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
 
     state = bot.get_state(m.from_user.id, m.chat.id)
     if state is None:
-        bot.send_message(m.chat.id, "Нет активной заявки. Нажмите /start", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
+        bot.send_message(m.chat.id, "Нет активной заявки. Нажмите /start", reply_markup=_menu_for(m.from_user.id))
         return
 
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
         action = data.get("action")
-        if action != "sell":
-            bot.send_message(m.chat.id, "Эта кнопка доступна только в процессе продажи. Нажмите /start", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
+        # кнопка теперь обрабатывается раньше хэндлеров состояний — без выбранной крипты она не к месту
+        if action != "sell" or not data.get("crypto"):
+            bot.send_message(m.chat.id, "Эта кнопка доступна только в процессе продажи. Нажмите /start", reply_markup=_menu_for(m.from_user.id))
             return
 
     bot.set_state(m.from_user.id, OrderStates.wait_tx, m.chat.id)
@@ -913,9 +1525,10 @@ def receive_tx(m: Message):
         action = data.get("action")
         amount = data.get("amount")
         crypto = data.get("crypto")
+        saved = dict(data)
 
     if action != "sell" or not all([amount, crypto]):
-        bot.send_message(m.chat.id, "Данные заявки потеряны. Начните заново: /start", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
+        bot.send_message(m.chat.id, "Данные заявки потеряны. Начните заново: /start", reply_markup=_menu_for(m.from_user.id))
         bot.delete_state(m.from_user.id, m.chat.id)
         return
 
@@ -939,38 +1552,54 @@ def receive_tx(m: Message):
         bot.send_message(m.chat.id, "❗️Не вижу реквизитов.\nНапишите строкой: <b>Выплата: ...</b>")
         return
 
-    order_id = db_create_order(m.from_user, "sell", amount, crypto, tx_info)
-    human = crypto_human(crypto)
-
-    payout_line = f"Выплата: <b>{escape_html(payout)}</b>\n"
-    tx_line = escape_html(tx_text) if tx_text else ("—" if not photo_id else "скриншот во вложении")
+    # Состояние снимаем здесь, в потоке шарда: новый сценарий или "Отмена", пришедшие, пока заявка
+    # пишется, живут своей жизнью, а повторный TX уходит в фолбэк, а не во второй заказ.
+    # "печатает..." — тоже отсюда, до постановки задачи: оно не придёт позже подтверждения.
+    bot.delete_state(m.from_user.id, m.chat.id)
+    safe_send_chat_action(m.chat.id, "typing")
+    IO_EXECUTOR.submit(_finalize_sell_order, m.from_user, m.chat.id, saved,
+                       tx_info, tx_text, payout, photo_id).add_done_callback(_log_task_error)
+
+def _log_task_error(future):
+    """done-callback для задач пула, чей результат никто не ждёт."""
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Ошибка фоновой задачи", exc_info=exc)
+
+def _finalize_sell_order(user, chat_id, saved: dict, tx_info, tx_text, payout, photo_id):
+    amount, crypto = saved["amount"], saved["crypto"]
+    try:
+        order_id = db_create_order(user, "sell", amount, crypto, tx_info)
+    except Exception:
+        logger.exception("Не удалось сохранить заявку на продажу от %s", user.id)
+        # возвращаем wait_tx, если юзер за это время не начал другое — тогда достаточно повторить TX
+        if state_storage.restore(chat_id, user.id, OrderStates.wait_tx, saved):
+            safe_send_message(chat_id, "⚠️ Не удалось создать заявку. Отправьте TX ещё раз.")
+        else:
+            safe_send_message(chat_id, "⚠️ Не удалось создать заявку. Начните заново: /start")
+        return
 
-    text = (
-        f"📩 <b>Новая заявка — ПРОДАЖА</b>\n\n"
-        f"ID заявки: <b>#{order_id}</b>\n"
-        f"Пользователь: {user_link(m.from_user)} @{escape_html(m.from_user.username or '—')}\n"
-        f"Сумма: <b>{escape_html(str(amount))}$</b>\n"
-        f"Криптовалюта: <b>{escape_html(human)}</b>\n"
-        f"{payout_line}"
-        f"TX: {(tx_line if not photo_id else 'скриншот во вложении')}\n"
-        f"Статус: <b>pending</b>"
-    )
+    text = _OP_SELL_TMPL.format_map({
+        "id": order_id,
+        "user": user_link(user),
+        "username": escape_html(user.username or "—"),
+        "amount": format_usd(amount),
+        "crypto": _CRYPTO_HUMAN[crypto],
+        "payout": escape_html(payout),
+        "tx": "скриншот во вложении" if photo_id else (escape_html(tx_text) or "—"),
+    })
 
     if photo_id:
-        safe_send_photo(OPERATOR_ID, photo_id, caption=text, reply_markup=operator_kb(order_id, m.from_user.id))
+        safe_send_photo(OPERATOR_ID, photo_id, caption=text, reply_markup=operator_kb(order_id, user.id))
     else:
-        safe_send_message(OPERATOR_ID, text, reply_markup=operator_kb(order_id, m.from_user.id))
+        safe_send_message(OPERATOR_ID, text, reply_markup=operator_kb(order_id, user.id))
 
-    bot.send_message(m.chat.id, f"✅ Заявка отправлена! Номер: <b>#{order_id}</b>\nОжидайте подтверждения.", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
-    bot.delete_state(m.from_user.id, m.chat.id)
+    safe_send_message(chat_id, f"✅ Заявка отправлена! Номер: <b>#{order_id}</b>\nОжидайте подтверждения.",
+                      reply_markup=_menu_for(user.id))
 
 # --- Решение оператора по заявке ---
-@bot.callback_query_handler(func=lambda c: c.data.startswith(("approve:", "reject:")))
+@operator_only(_deny_callback)
 def operator_decision(c: CallbackQuery):
-    if c.from_user.id != OPERATOR_ID:
-        bot.answer_callback_query(c.id, "Недостаточно прав")
-        return
-
     action, id_str = c.data.split(":", 1)
     try:
         order_id = int(id_str)
@@ -979,32 +1608,39 @@ def operator_decision(c: CallbackQuery):
         return
 
     row = db_get_order(order_id)
-    if not row:
+    if row is None:
         bot.answer_callback_query(c.id, "Заявка не найдена")
         return
+    user_id = row["user_id"]
 
-    user_id = row[1]
     status = "approved" if action == "approve" else "rejected"
-    db_update_status(order_id, status)
+    # повторный клик (лагающий клиент): без второй записи и второго уведомления
+    if row["status"] != "pending" or db_update_status(order_id, status, expected="pending") != "pending":
+        bot.answer_callback_query(c.id, "Уже обработано")
+        _drop_operator_kb(c)
+        return
 
     if status == "approved":
-        safe_send_message(user_id, f"✅ Ваша заявка <b>#{order_id}</b> — <b>Одобрено</b>.")
+        send_in_background(safe_send_message, user_id, f"✅ Ваша заявка <b>#{order_id}</b> — <b>Одобрено</b>.")
         bot.answer_callback_query(c.id, "Одобрено")
     else:
-        safe_send_message(user_id, f"❌ Ваша заявка <b>#{order_id}</b> — <b>Отклонено</b>.\nЕсли нужно — нажмите «Поддержка».")
+        send_in_background(
+            safe_send_message, user_id,
+            f"❌ Ваша заявка <b>#{order_id}</b> — <b>Отклонено</b>.\nЕсли нужно — нажмите «Поддержка»."
+        )
         bot.answer_callback_query(c.id, "Отклонено")
 
+    _drop_operator_kb(c)
+
+def _drop_operator_kb(c: CallbackQuery):
     try:
         bot.edit_message_reply_markup(chat_id=c.message.chat.id, message_id=c.message.message_id, reply_markup=None)
     except Exception:
         pass
 
 # --- Бан / разбан пользователя ---
-@bot.callback_query_handler(func=lambda c: c.data.startswith("ban:"))
+@operator_only(_deny_callback)
 def operator_ban(c: CallbackQuery):
-    if c.from_user.id != OPERATOR_ID:
-        bot.answer_callback_query(c.id, "Недостаточно прав")
-        return
     try:
         user_id = int(c.data.split(":", 1)[1])
     except ValueError:
@@ -1012,14 +1648,11 @@ def operator_ban(c: CallbackQuery):
         return
 
     db_set_user_blocked(user_id, True)
-    safe_send_message(user_id, "🚫 Доступ запрещён.")
+    send_in_background(safe_send_message, user_id, "🚫 Доступ запрещён.")
     bot.answer_callback_query(c.id, "Пользователь заблокирован")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("unban:"))
+@operator_only(_deny_callback)
 def operator_unban(c: CallbackQuery):
-    if c.from_user.id != OPERATOR_ID:
-        bot.answer_callback_query(c.id, "Недостаточно прав")
-        return
     try:
         user_id = int(c.data.split(":", 1)[1])
     except ValueError:
@@ -1027,16 +1660,13 @@ def operator_unban(c: CallbackQuery):
         return
 
     db_set_user_blocked(user_id, False)
-    safe_send_message(user_id, "✅ Вы разблокированы. Можете пользоваться ботом.")
+    _recently_blocked.discard(user_id)
+    send_in_background(safe_send_message, user_id, "✅ Вы разблокированы. Можете пользоваться ботом.")
     bot.answer_callback_query(c.id, "Пользователь разблокирован")
 
 # ---------------- Админка ----------------
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "⚙️ Админка")
+@operator_only(_deny_message)
 def admin_panel(m: Message):
-    if m.from_user.id != OPERATOR_ID:
-        bot.send_message(m.chat.id, "Недостаточно прав.", reply_markup=main_menu(False))
-        return
-
     bot.set_state(m.from_user.id, AdminStates.choose, m.chat.id)
 
     text = (
@@ -1049,69 +1679,46 @@ def admin_panel(m: Message):
         f"LTC кошелёк: <code>{escape_html(get_wallet('LTC'))}</code>\n"
         f"Поддержка: <b>{escape_html(get_support_username())}</b>\n"
     )
-    bot.send_message(m.chat.id, text, reply_markup=admin_menu_kb())
+    bot.send_message(m.chat.id, text, reply_markup=_ADMIN_MENU_KB)
 
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "⬅ Назад", state=AdminStates.choose)
 def admin_back(m: Message):
     bot.delete_state(m.from_user.id, m.chat.id)
-    bot.send_message(m.chat.id, "Ок.", reply_markup=main_menu(True))
+    bot.send_message(m.chat.id, "Ок.", reply_markup=_MAIN_MENU_OP)
+
+# пункт меню -> (ключ settings, подсказка)
+_ADMIN_EDITS = {
+    "Курс покупки": ("buy_rate", "Введи новый курс покупки (пример: 18.6):"),
+    "Курс продажи": ("sell_rate", "Введи новый курс продажи (пример: 16.5):"),
+    "Мин сумма": ("min_usd", "Введи минимальную сумму в $ (пример: 10):"),
+    "Добавление криптовалюты": ("cryptos", "Введи список через запятую (USDT_TRON,LTC):"),
+    "Юзер оператора": ("support_username", "Введи @username оператора (пример: @TOM_EXCH_PMR):"),
+}
 
 @bot.message_handler(state=AdminStates.choose, content_types=["text"])
+@operator_only(_drop_state)
 def admin_choose(m: Message):
-    if m.from_user.id != OPERATOR_ID:
-        bot.delete_state(m.from_user.id, m.chat.id)
-        return
-
     t = (m.text or "").strip()
+    if t == "⬅ Назад":
+        admin_back(m)
+        return
 
-    if t == "Курс покупки":
-        with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data["edit"] = "buy_rate"
-        bot.set_state(m.from_user.id, AdminStates.wait_value, m.chat.id)
-        bot.send_message(m.chat.id, "Введи новый курс покупки (пример: 18.6):")
-
-    elif t == "Курс продажи":
-        with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data["edit"] = "sell_rate"
-        bot.set_state(m.from_user.id, AdminStates.wait_value, m.chat.id)
-        bot.send_message(m.chat.id, "Введи новый курс продажи (пример: 16.5):")
-
-    elif t == "Мин сумма":
-        with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data["edit"] = "min_usd"
-        bot.set_state(m.from_user.id, AdminStates.wait_value, m.chat.id)
-        bot.send_message(m.chat.id, "Введи минимальную сумму в $ (пример: 10):")
-
-    elif t == "Добавление криптовалюты":
+    edit = _ADMIN_EDITS.get(t)
+    if edit:
+        key, prompt = edit
         with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data["edit"] = "cryptos"
+            data["edit"] = key
         bot.set_state(m.from_user.id, AdminStates.wait_value, m.chat.id)
-        bot.send_message(m.chat.id, "Введи список через запятую (USDT_TRON,LTC):")
+        bot.send_message(m.chat.id, prompt)
 
     elif t == "Кошельки":
         bot.set_state(m.from_user.id, AdminStates.wait_wallet_crypto, m.chat.id)
-        kb = InlineKeyboardMarkup()
-        kb.add(
-            InlineKeyboardButton("USDT_TRON", callback_data="admin_wallet:USDT_TRON"),
-            InlineKeyboardButton("LTC", callback_data="admin_wallet:LTC"),
-        )
-        bot.send_message(m.chat.id, "Выбери крипту для смены кошелька:", reply_markup=kb)
-
-    elif t == "Юзер оператора":
-        with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data["edit"] = "support_username"
-        bot.set_state(m.from_user.id, AdminStates.wait_value, m.chat.id)
-        bot.send_message(m.chat.id, "Введи @username оператора (пример: @TOM_EXCH_PMR):")
+        bot.send_message(m.chat.id, "Выбери крипту для смены кошелька:", reply_markup=_WALLET_PICK_KB)
 
     else:
-        bot.send_message(m.chat.id, "Выбери пункт из меню.", reply_markup=admin_menu_kb())
+        bot.send_message(m.chat.id, "Выбери пункт из меню.", reply_markup=_ADMIN_MENU_KB)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("admin_wallet:"), state=AdminStates.wait_wallet_crypto)
+@operator_only(_deny_callback)
 def admin_wallet_pick(c: CallbackQuery):
-    if c.from_user.id != OPERATOR_ID:
-        bot.answer_callback_query(c.id, "Недостаточно прав")
-        return
-
     code = c.data.split(":", 1)[1]
     if code not in ALLOWED_CRYPTOS:
         bot.answer_callback_query(c.id, "Неверно")
@@ -1126,11 +1733,8 @@ def admin_wallet_pick(c: CallbackQuery):
     bot.send_message(c.message.chat.id, f"Введи новый кошелёк для {code}:")
 
 @bot.message_handler(state=AdminStates.wait_value, content_types=["text"])
+@operator_only(_drop_state)
 def admin_set_value(m: Message):
-    if m.from_user.id != OPERATOR_ID:
-        bot.delete_state(m.from_user.id, m.chat.id)
-        return
-
     value = (m.text or "").strip()
 
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
@@ -1143,11 +1747,9 @@ def admin_set_value(m: Message):
             bot.send_message(m.chat.id, "Слишком короткий адрес. Введи кошелёк ещё раз.")
             return
         db_set_setting(f"wallet_{wallet_code}", value)
-        with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
-            data.pop("wallet_code", None)
-            data.pop("edit", None)
+        bot.reset_data(m.from_user.id, m.chat.id)
         bot.set_state(m.from_user.id, AdminStates.choose, m.chat.id)
-        bot.send_message(m.chat.id, "✅ Кошелёк сохранён.", reply_markup=admin_menu_kb())
+        bot.send_message(m.chat.id, "✅ Кошелёк сохранён.", reply_markup=_ADMIN_MENU_KB)
         return
 
     # числа
@@ -1183,47 +1785,181 @@ def admin_set_value(m: Message):
     else:
         bot.send_message(m.chat.id, "Не понял что менять. Вернись в админку.")
         bot.set_state(m.from_user.id, AdminStates.choose, m.chat.id)
-        bot.send_message(m.chat.id, "⚙️ Админка:", reply_markup=admin_menu_kb())
+        bot.send_message(m.chat.id, "⚙️ Админка:", reply_markup=_ADMIN_MENU_KB)
         return
 
     bot.set_state(m.from_user.id, AdminStates.choose, m.chat.id)
-    bot.send_message(m.chat.id, "✅ Сохранено.", reply_markup=admin_menu_kb())
+    bot.send_message(m.chat.id, "✅ Сохранено.", reply_markup=_ADMIN_MENU_KB)
 
 # ---------------- Рассылка (только оператор) ----------------
-@bot.message_handler(func=lambda m: getattr(m, "text", "") == "📢 Рассылка")
+class TokenBucket:
+    """Ограничитель скорости: не больше rate вызовов acquire() в секунду."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.paused_until = 0.0
+        self.last_pause = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.cond.wait((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Остановить выдачу токенов на seconds (после 429 ждут все воркеры разом).
+        Паузы не суммируются: одновременные 429 от разных воркеров дают одну, самую длинную.
+        """
+        with self.cond:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.paused_until = max(self.paused_until, self.updated + seconds)
+
+    def backoff(self, retry_after: float, max_factor: int = 8) -> float:
+        """
+        Пауза после 429, возвращает её длину. 429 во время текущей паузы — тот же всплеск,
+        пауза не растёт; 429 вскоре после её окончания — удваиваем прошлую (не больше max_factor раз).
+        """
+        with self.cond:
+            now = time.monotonic()
+            base = retry_after + 1
+            if now < self.paused_until:
+                delay = max(base, self.paused_until - now)
+            elif now < self.paused_until + self.last_pause:
+                delay = min(max(base, self.last_pause * 2), base * max_factor)
+            else:
+                delay = base
+            if now >= self.paused_until:
+                self.last_pause = delay
+            self.pause(delay)
+            return delay
+
+def _broadcast_send(bucket: TokenBucket, uid, src_chat_id, src_message_id, attempt: int) -> str:
+    """
+    Одна попытка копии рассылки: 'sent', 'blocked', 'failed' или 'retry'.
+    На 429 не ждёт сама: ставит bucket на паузу (TokenBucket.backoff) и просит повтор.
+    """
+    try:
+        bot.copy_message(uid, src_chat_id, src_message_id)
+        return "sent"
+    except ApiTelegramException as e:
+        if e.error_code == 403:
+            return "blocked"
+        if e.error_code == 429 and attempt < BROADCAST_RETRIES:
+            delay = bucket.backoff(_extract_retry_after(e) or 5)
+            logger.warning("copy_message to %s: 429, пауза рассылки %s с", uid, delay)
+            return "retry"
+        logger.warning("copy_message to %s: %s", uid, e)
+        return "failed"
+    except Exception:
+        logger.exception("Ошибка copy_message to %s", uid)
+        return "failed"
+
+def run_broadcast(src_chat_id, src_message_id):
+    bucket = TokenBucket(BROADCAST_RATE)
+    # не больше BROADCAST_WORKERS задач в IO_EXECUTOR: остальные его потоки свободны для уведомлений и заявок
+    inflight = threading.BoundedSemaphore(BROADCAST_WORKERS)
+    retries = queue.Queue()  # (uid, attempt) после 429 — их снова отправляет этот поток
+    counters_lock = threading.Lock()
+    counts = Counter()
+    blocked = []
+
+    def send_one(uid, attempt):
+        result = "failed"
+        try:
+            result = _broadcast_send(bucket, uid, src_chat_id, src_message_id, attempt)
+        finally:
+            inflight.release()
+            if result == "retry":
+                retries.put((uid, attempt + 1))
+            else:
+                with counters_lock:
+                    counts[result] += 1
+                    if result == "blocked":
+                        blocked.append(uid)
+
+    def submit(uid, attempt=0):
+        # токен и пауза после 429 ждутся здесь, в потоке рассылки, а не в воркере пула
+        inflight.acquire()
+        bucket.acquire()
+        IO_EXECUTOR.submit(send_one, uid, attempt)
+
+    def resubmit(wait=False):
+        while True:
+            try:
+                uid, attempt = retries.get(timeout=0.2) if wait else retries.get_nowait()
+            except queue.Empty:
+                return
+            submit(uid, attempt)
+            wait = False
+
+    total = 0
+    for uid in db_all_user_ids(only_active=True):
+        if uid == OPERATOR_ID or uid in _recently_blocked:
+            continue
+        total += 1
+        submit(uid)
+        resubmit()
+    # хвост: ждём итог по каждому получателю, попутно переотправляя 429
+    while True:
+        with counters_lock:
+            if sum(counts.values()) >= total:
+                break
+        resubmit(wait=True)
+    if blocked:
+        # все 403 рассылки — одной транзакцией
+        logger.info("Рассылка: %s пользователей заблокировали бота", len(blocked))
+        _recently_blocked.update(blocked)
+        try:
+            db_set_users_blocked(blocked)
+        except Exception:
+            logger.exception("Не удалось пометить пользователей как заблокированных")
+    safe_send_message(OPERATOR_ID, f"Рассылка завершена.\nУспешно: {counts['sent']}\nОшибок: {counts['failed'] + counts['blocked']}", reply_markup=_MAIN_MENU_OP)
+
+# Рассылки выполняет один долгоживущий поток по очереди: две рассылки не идут одновременно
+_broadcast_jobs = queue.Queue()
+
+def _broadcast_loop():
+    while True:
+        src_chat_id, src_message_id = _broadcast_jobs.get()
+        try:
+            run_broadcast(src_chat_id, src_message_id)
+        except Exception:
+            logger.exception("Ошибка рассылки")
+
+@operator_only(_deny_message)
 def start_broadcast(m: Message):
-    if m.from_user.id != OPERATOR_ID:
-        bot.send_message(m.chat.id, "Недостаточно прав.", reply_markup=main_menu(False))
-        return
     bot.set_state(m.from_user.id, BroadcastStates.wait_content, m.chat.id)
-    kb = ReplyKeyboardMarkup(resize_keyboard=True).add(KeyboardButton("Отмена"))
-    bot.send_message(m.chat.id, "Отправьте текст/медиа для рассылки (любое сообщение).", reply_markup=kb)
+    bot.send_message(m.chat.id, "Отправьте текст/медиа для рассылки (любое сообщение).", reply_markup=_CANCEL_KB)
 
 @bot.message_handler(state=BroadcastStates.wait_content, content_types=[
     "text","photo","video","document","audio","voice","video_note","animation","sticker"
 ])
+@operator_only(_drop_state)
 def broadcast_got_content(m: Message):
-    if m.from_user.id != OPERATOR_ID:
-        bot.delete_state(m.from_user.id, m.chat.id)
-        return
     with bot.retrieve_data(m.from_user.id, m.chat.id) as data:
         data["src_chat_id"] = m.chat.id
         data["src_message_id"] = m.message_id
-    total = len(db_all_user_ids(only_active=False))
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton(f"▶ Отправить ({total})", callback_data="broadcast:send"),
-        InlineKeyboardButton("Отмена", callback_data="broadcast:cancel")
-    )
+    total = db_count_users(only_active=True)
     bot.set_state(m.from_user.id, BroadcastStates.confirm, m.chat.id)
-    bot.send_message(m.chat.id, f"Готовы отправить рассылку {total} пользователям?", reply_markup=kb)
+    bot.send_message(m.chat.id, f"Готовы отправить рассылку {total} пользователям?",
+                     reply_markup=_broadcast_confirm_kb(total))
 
-@bot.callback_query_handler(func=lambda c: c.data in ["broadcast:send","broadcast:cancel"], state=BroadcastStates.confirm)
+@operator_only(_deny_callback)
 def broadcast_confirm(c: CallbackQuery):
-    if c.from_user.id != OPERATOR_ID:
-        bot.answer_callback_query(c.id, "Недостаточно прав")
-        return
-
     if c.data == "broadcast:cancel":
         bot.delete_state(c.from_user.id, c.message.chat.id)
         try:
@@ -1231,7 +1967,7 @@ def broadcast_confirm(c: CallbackQuery):
         except Exception:
             pass
         bot.answer_callback_query(c.id, "Рассылка отменена")
-        bot.send_message(c.message.chat.id, "Отменено.", reply_markup=main_menu(True))
+        bot.send_message(c.message.chat.id, "Отменено.", reply_markup=_MAIN_MENU_OP)
         return
 
     with bot.retrieve_data(c.from_user.id, c.message.chat.id) as data:
@@ -1244,55 +1980,122 @@ def broadcast_confirm(c: CallbackQuery):
         pass
     bot.answer_callback_query(c.id, "Рассылка запущена")
 
-    def run_broadcast():
-        users = db_all_user_ids(only_active=False)
-        sent = 0
-        failed = 0
-        for uid in users:
-            if uid == OPERATOR_ID:
-                continue
-            res = safe_copy_message(uid, src_chat_id, src_message_id)
-            if res is not None:
-                sent += 1
-            else:
-                failed += 1
-            time.sleep(0.06)
-        safe_send_message(OPERATOR_ID, f"Рассылка завершена.\nУспешно: {sent}\nОшибок: {failed}", reply_markup=main_menu(True))
-
-    threading.Thread(target=run_broadcast, daemon=True).start()
+    _broadcast_jobs.put((src_chat_id, src_message_id))
     bot.delete_state(c.from_user.id, c.message.chat.id)
 
+# --- Маршруты кнопок (см. route_text) ---
+_TEXT_ROUTES = {
+    "Отмена": cancel_btn,
+    "👨‍💻 Поддержка": support,
+    "🎁 Бонусы": bonuses,
+    "👤 Личный кабинет": profile,
+    "📄 Мои заявки": my_orders,
+    "💰 Купить крипту": buy_crypto,
+    "💸 Продать крипту": sell_crypto,
+    "📤 Я отправил": confirm_sent,
+    "⚙️ Админка": admin_panel,
+    "📢 Рассылка": start_broadcast,
+}
+
+# префикс callback_data -> (хэндлер, нужное состояние или None); см. route_callback
+_CALLBACK_ROUTES = {
+    "myorders": (myorders_refresh, None),
+    "crypto": (select_crypto, OrderStates.crypto),
+    "buymethod": (select_buy_method, OrderStates.buy_method),
+    "approve": (operator_decision, None),
+    "reject": (operator_decision, None),
+    "ban": (operator_ban, None),
+    "unban": (operator_unban, None),
+    "admin_wallet": (admin_wallet_pick, AdminStates.wait_wallet_crypto),
+    "broadcast": (broadcast_confirm, BroadcastStates.confirm),
+}
+
 # --- Фолбэк ---
 @bot.message_handler(func=lambda m: True)
 def fallback(m: Message):
     if deny_if_blocked(m.from_user.id, m.chat.id):
         return
-    bot.send_message(m.chat.id, "Выберите действие из меню или нажмите /start", reply_markup=main_menu(m.from_user.id == OPERATOR_ID))
+    bot.send_message(m.chat.id, "Выберите действие из меню или нажмите /start", reply_markup=_menu_for(m.from_user.id))
+
+# ---------------- Webhook ----------------
+class WebhookHandler(BaseHTTPRequestHandler):
+    """POST от Telegram: сразу отвечаем 200, апдейт уходит в очередь своего чата (ShardedTeleBot)."""
+
+    def do_POST(self):
+        if self.path != (urlparse(WEBHOOK_URL).path or "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= WEBHOOK_MAX_BODY:
+            self.send_response(413 if length > WEBHOOK_MAX_BODY else 400)
+            self.end_headers()
+            return
+        try:
+            update = Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except Exception:
+            logger.exception("Некорректный апдейт в webhook")
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        if update is not None:
+            bot.process_new_updates([update])
+
+    def log_message(self, format, *args):
+        pass
 
 # ---------------- Запуск ----------------
 if __name__ == "__main__":
     db_init()
 
     # один раз проставим дефолты в settings (если ещё пусто)
-    if db_get_setting("buy_rate") is None:
-        db_set_setting("buy_rate", DEFAULT_BUY_RATE)
-    if db_get_setting("sell_rate") is None:
-        db_set_setting("sell_rate", DEFAULT_SELL_RATE)
-    if db_get_setting("min_usd") is None:
-        db_set_setting("min_usd", DEFAULT_MIN_USD)
-    if db_get_setting("cryptos") is None:
-        db_set_setting("cryptos", DEFAULT_CRYPTOS)
-    if db_get_setting("support_username") is None:
-        db_set_setting("support_username", DEFAULT_SUPPORT_USERNAME)
-    if db_get_setting("wallet_USDT_TRON") is None:
-        db_set_setting("wallet_USDT_TRON", USDT_WALLET_DEFAULT)
-    if db_get_setting("wallet_LTC") is None:
-        db_set_setting("wallet_LTC", LTC_WALLET_DEFAULT)
+    db_seed_settings(DEFAULT_SETTINGS)
+
+    if STATE_PATH:
+        try:
+            state_storage.load(STATE_PATH)
+        except Exception:
+            logger.exception("Не удалось загрузить состояния из %s", STATE_PATH)
+        atexit.register(state_storage.dump, STATE_PATH)
+
+    # docker stop / systemctl stop шлют SIGTERM: обрабатываем как Ctrl+C, чтобы выйти штатно
+    # и отработали atexit, включая снимок состояний
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    threading.Thread(target=_upsert_loop, name="user-upsert", daemon=True).start()
+    # хвост очереди (до UPSERT_BATCH_WINDOW последних секунд) — при выходе, до закрытия соединений
+    atexit.register(flush_upserts)
+    threading.Thread(target=_broadcast_loop, name="broadcast", daemon=True).start()
 
     bot.add_custom_filter(custom_filters.StateFilter(bot))
     bot.add_custom_filter(custom_filters.TextMatchFilter())
 
-    bot.remove_webhook()  # важно: выключаем webhook, иначе polling не получит сообщения
-    logger.info("Bot started")
-    bot.infinity_polling(timeout=30, long_polling_timeout=30, skip_pending=True)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+        server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+        logger.info("Bot started (webhook %s, listen %s:%s)", WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Bot stopped")
+        finally:
+            server.server_close()
+    else:
+        bot.remove_webhook()  # важно: выключаем webhook, иначе polling не получит сообщения
+        logger.info("Bot started")
+        try:
+            bot.infinity_polling(timeout=30, long_polling_timeout=30, skip_pending=True)
+        except KeyboardInterrupt:
+            # сигнал пришёл в паузе между перезапусками polling — выходим так же штатно
+            logger.info("Bot stopped")
 